@@ -7,14 +7,22 @@ containing request URIs and expected status codes and headers for the response."
 # pylint: disable=invalid-name
 
 import argparse
+import atexit
+import codecs
+import itertools
 import json
 import re
 import os
 import sys
+import threading
+from pathlib import Path
+from collections import OrderedDict, deque
+from concurrent.futures import Future, ThreadPoolExecutor
 from dataclasses import dataclass
+from urllib.parse import urlsplit
 import requests
-from lxml import html
-from lxml.etree import XPathEvalError  # pylint: disable=no-name-in-module
+import urllib3
+from requests.adapters import HTTPAdapter
 
 
 VERSION = "0.0.4"
@@ -24,6 +32,15 @@ GRE = "\033[32m"
 YEL = "\033[33m"
 NON = "\033[0m"
 
+# Diff line prefixes
+EXPECTED = f"\t{GRE}-"
+ACTUAL = f"\t{RED}+"
+
+# Mounted into the sessions of all test cases, so that keep-alive connections
+# are reused across tests instead of being re-established for each request.
+# Sized according to `--jobs` when run as a script.
+_adapter = HTTPAdapter(pool_connections=32, pool_maxsize=64)
+
 
 @dataclass
 class ExpectedResponse:
@@ -33,7 +50,143 @@ class ExpectedResponse:
         self.line = line
         self.status = status
         self.headers = {}
-        self.data = []
+        self.data = []  # list[tuple[check, compiled payload, line from file]]
+
+
+class ResponseBody:
+    """Reads the body of a streamed response only as far as the checks need it.
+    UTF-8 bodies are searched as they are, without decoding them."""
+
+    chunk_size = 65536
+
+    def __init__(self, resp: requests.Response) -> None:
+        self._resp = resp
+
+        try:
+            encoding = codecs.lookup(resp.encoding).name
+        except (LookupError, TypeError):
+            encoding = None  # none or unknown
+
+        self._utf8 = encoding == "utf-8"
+        self._empty = b"" if self._utf8 else ""
+        self._parts = []  # read so far, decoded unless UTF-8
+        self._chunks = self._iter(encoding)
+        self._text = None
+        self._doc = None
+
+    def _iter(self, encoding: str):  # -> Iterator[bytes | str]
+        if self._utf8:
+            yield from self._resp.iter_content(self.chunk_size)
+        elif encoding is None:
+            # Encoding has to be guessed from the complete body
+            yield self._resp.text
+        else:
+            yield from self._resp.iter_content(self.chunk_size, decode_unicode=True)
+
+    def _read(self):  # -> bytes | str
+        """Return what was read so far, joining the parts only once"""
+        if len(self._parts) > 1:
+            self._parts = [self._empty.join(self._parts)]
+
+        return self._parts[0] if self._parts else self._empty
+
+    def contains(self, needle: str, encoded: bytes) -> bool:
+        """Check for `needle`, reading no further than its first occurrence.
+        `encoded` is `needle` in UTF-8, for searching UTF-8 bodies."""
+        if self._utf8:
+            needle = encoded
+
+        read = self._read()
+
+        if needle in read:
+            return True
+
+        # `needle` may start within the last `keep` bytes/chars before a chunk
+        keep = len(needle) - 1
+        tail = read[max(len(read) - keep, 0) :] if keep else self._empty
+
+        for chunk in self._chunks:
+            self._parts.append(chunk)
+            window = tail + chunk
+
+            if needle in window:
+                return True
+
+            tail = window[max(len(window) - keep, 0) :] if keep else self._empty
+
+        return False
+
+    @property
+    def text(self) -> str:
+        """Return the complete body"""
+        if self._text is None:
+            self._parts.extend(self._chunks)
+            read = self._read()
+
+            if self._utf8:
+                self._text = str(read, "utf-8", errors="replace")
+            else:
+                self._text = read
+
+        return self._text
+
+    def close(self) -> None:
+        """Release the connection. If only a little of the body is left unread,
+        it is read up for the connection to be reused. Otherwise the connection
+        is dropped rather than downloading what nobody is going to check."""
+        raw = self._resp.raw
+        remaining = raw.length_remaining
+
+        if remaining is None:
+            # Chunked, so the length left is unknown: read at most one more chunk.
+            # If that reaches the end, the connection is released to the pool.
+            try:
+                raw.read(self.chunk_size)
+            except (OSError, urllib3.exceptions.HTTPError):
+                pass
+        elif remaining <= self.chunk_size:
+            raw.drain_conn()
+
+        self._resp.close()
+
+    @property
+    def doc(self):  # -> lxml.html.HtmlElement
+        """Return the body parsed as HTML, parsing it on first access only"""
+        if self._doc is None:
+            from lxml import html  # pylint: disable=import-outside-toplevel
+
+            self._doc = html.document_fromstring(self.text)
+
+        return self._doc
+
+
+def _check_substr(needle: tuple, body: ResponseBody) -> bool:
+    """`=`: body contains the text, given as `str` and UTF-8 encoded `bytes`"""
+    return body.contains(*needle)
+
+
+def _check_regex(regex: re.Pattern, body: ResponseBody) -> bool:
+    """`~`: body matches the regex"""
+    return regex.search(body.text) is not None
+
+
+def _check_xpath(xpath, body: ResponseBody) -> bool:  # xpath: lxml.etree.XPath
+    """`/`: XPath is found in the body's HTML document"""
+    # pylint: disable=import-outside-toplevel,no-name-in-module
+    from lxml.etree import XPathEvalError
+
+    try:
+        return bool(xpath(body.doc))
+    except XPathEvalError:
+        return False
+
+
+# Body checks by their operator in the test file
+_OPS = {
+    "=": _check_substr,
+    "~": _check_regex,
+    "/": _check_xpath,
+}
 
 
 class NoStatusCodeForResponse(RuntimeError):
@@ -49,8 +202,14 @@ class NoStatusCodeForResponse(RuntimeError):
 class Testcase:
     """Conducts and evaluate tests, holds test data"""
 
+    cache = True  # Share responses between tests sending the same request
     cookies = {}
-    headers = {}
+    fetched = OrderedDict()  # Responses shared between tests, most recent last
+    fetching = threading.Lock()
+    headers = {
+        "Cache-Control": "no-cache, no-store",
+        "Pragma": "no-cache",
+    }
 
     @dataclass
     class Diff:
@@ -75,36 +234,36 @@ class Testcase:
                     name = f"{self.name}: "
                     actual = self.actual
 
-                items += [f"\t{GRE}-{name}{self.expected}{NON}"]
+                items.append(f"{EXPECTED}{name}{self.expected}{NON}")
 
                 if self.actual:
-                    items += [f"\t{RED}+{name}{actual}{NON}"]
+                    items.append(f"{ACTUAL}{name}{actual}{NON}")
                 else:
-                    items += [f"\t{RED}+{name}{NON}"]
+                    items.append(f"{ACTUAL}{name}{NON}")
             else:
-                items += [f"\t{GRE}-{self.expected}{NON}"]
+                items.append(f"{EXPECTED}{self.expected}{NON}")
 
                 if self.actual:
-                    items += [f"\t{RED}+{self.actual}{NON}"]
+                    items.append(f"{ACTUAL}{self.actual}{NON}")
 
             return items
 
-    report: list = []  # list[Diff]
-
-    def __init__(self, line: int, uri: str, method=None) -> None:
+    def __init__(self, line: int, uri: str, method: str = "HEAD") -> None:
         self._line = line
         self._uri = uri
         self._method = method.lower()  # as the requests method names ...
         self._responses = []
+        self.report = []  # list[Diff]
 
     def __str__(self) -> str:
         """Format unexpeted results in a diff-like format"""
         items = [f"<@ {self.line}: {self.uri}"]
 
-        for diff in Testcase.report:
-            items += diff.items()
+        for diff in self.report:
+            items.extend(diff.items())
 
-        return os.linesep.join(items)
+        # `print()` translates "\n" to the platform's line separator
+        return "\n".join(items)
 
     @property
     def line(self) -> str:
@@ -133,7 +292,7 @@ class Testcase:
 
     def addresp(self, line: int, status: int) -> None:
         """Adds expected HTTP status to the response list"""
-        self._responses += [ExpectedResponse(line, status)]
+        self._responses.append(ExpectedResponse(line, status))
 
     def addheader(self, header: str, content: str) -> None:
         """Adds expected header data to the response list"""
@@ -142,12 +301,31 @@ class Testcase:
 
         self._responses[-1].headers[header] = content
 
-    def adddata(self, content: str) -> None:
-        """Adds expected body data to the response list"""
+    def adddata(self, line: int, content: str) -> None:
+        """Adds expected body data to the response list.
+        Regexes and XPaths are compiled once here instead of for every response"""
         if not self._responses:
             raise NoStatusCodeForResponse
 
-        self._responses[-1].data += [content]
+        op, payload = content[:1], content[1:]
+
+        if op == "=":
+            payload = (payload, payload.encode("utf-8"))
+        elif op == "~":
+            try:
+                payload = re.compile(payload)
+            except re.error as error:
+                raise SyntaxWarning(line) from error
+        elif op == "/":
+            # lxml is only loaded for test files using XPaths
+            from lxml import etree  # pylint: disable=import-outside-toplevel
+
+            try:
+                payload = etree.XPath(content)
+            except etree.XPathSyntaxError as error:
+                raise SyntaxWarning(line) from error
+
+        self._responses[-1].data.append((_OPS[op], payload, content))
 
     def __repr__(self) -> str:
         resp = json.dumps(self._responses, indent=4)
@@ -155,79 +333,155 @@ class Testcase:
 
         return f"\033[37;1m{self.uri}\033[m{method} \033[36m{resp}\033[m"
 
-    def execute(self) -> bool:
-        """Executes requests and evaluates responses.
-        Follows redirections as long as according responses are defined.
-        Adds unexpected results to `Testcase.report`"""
-        # pylint: disable=too-many-branches
-        nocache = {
-            "Cache-Control": "no-cache, no-store",
-            "Pragma": "no-cache",
-        }
-
-        uri = self.uri
+    @property
+    def cacheable(self) -> bool:
+        """Indicate whether responses may be shared with other tests"""
+        if not Testcase.cache or self.method not in ("get", "head"):
+            return False
+
+        # Tests expecting responses not to be cached should get fresh ones
+        return not any(
+            header.lower() == "cache-control" and "no-cache" in content
+            for expect in self.responses
+            for header, content in expect.headers.items()
+        )
 
+    @staticmethod
+    def session() -> requests.Session:
+        """Create a session for a single test case. Each test gets its own
+        session for cookies to not leak between tests."""
         s = requests.session()
         s.trust_env = False
+        s.mount("http://", _adapter)
+        s.mount("https://", _adapter)
+        s.headers.update(Testcase.headers)
 
         requests_ca_bundle = os.getenv("REQUESTS_CA_BUNDLE", default=None)
 
         if requests_ca_bundle:
             s.verify = requests_ca_bundle
 
-        for expect in self.responses:
-            allow_redirects = not self.method == "head"
-            method = getattr(s, self.method)
-
-            resp = method(
-                uri,
-                headers={**Testcase.headers, **nocache},
-                cookies=Testcase.cookies,
-                allow_redirects=allow_redirects,
+        return s
+
+    @staticmethod
+    def hops(s: requests.Session, method: str, uri: str, stream: bool):
+        """Sends the request and yields its response, followed by the responses
+        along the redirections. Each redirection is only followed once the
+        previous response has been taken from the iterator."""
+        allow_redirects = not method == "head"
+
+        resp = s.request(
+            method,
+            uri,
+            cookies=Testcase.cookies,
+            allow_redirects=allow_redirects,
+            stream=stream,
+        )
+
+        yield resp
+        yield from s.resolve_redirects(
+            resp, resp.request, stream=stream, verify=s.verify
+        )
+
+    @staticmethod
+    def fetch(method: str, uri: str, count: int, bodies: bool, *key) -> tuple:
+        """Get up to `count` responses along the redirections, once per run.
+        Tests sending a request already in flight wait for its responses.
+        With `bodies`, these are read completely, so the responses can be checked
+        by any number of tests. Further arguments only serve as part of the key."""
+        key = (method, uri, count, bodies, *key)
+
+        with Testcase.fetching:
+            future = Testcase.fetched.get(key)
+            first = future is None
+
+            if first:
+                future = Testcase.fetched[key] = Future()
+
+                if len(Testcase.fetched) > 1024:
+                    Testcase.fetched.popitem(last=False)
+            else:
+                Testcase.fetched.move_to_end(key)
+
+        if not first:
+            return future.result()
+
+        try:
+            hops = Testcase.hops(Testcase.session(), method, uri, not bodies)
+            resps = tuple(itertools.islice(hops, count))
+        except Exception as error:
+            # Let waiting tests fail alike, but later ones retry
+            with Testcase.fetching:
+                Testcase.fetched.pop(key, None)
+
+            future.set_exception(error)
+            raise
+
+        if resps and not bodies:
+            # Previous hops have been read when following their redirections
+            ResponseBody(resps[-1]).close()
+
+        future.set_result(resps)
+
+        return resps
+
+    def execute(self) -> bool:
+        """Executes requests and evaluates responses.
+        Follows redirections as long as according responses are defined.
+        Adds unexpected results to `self.report`"""
+        # pylint: disable=too-many-branches
+        cached = self.cacheable
+
+        if cached:
+            hops = iter(
+                Testcase.fetch(
+                    self.method,
+                    self.uri,
+                    len(self.responses),
+                    any(expect.data for expect in self.responses),
+                    frozenset(Testcase.headers.items()),
+                    frozenset(Testcase.cookies.items()),
+                )
             )
+        else:
+            # Bodies are only read as far as the checks need them
+            hops = Testcase.hops(Testcase.session(), self.method, self.uri, True)
 
+        for expect in self.responses:
             line = expect.line
             status = expect.status
 
-            if int(resp.status_code) != status:
-                Testcase.report += [Testcase.Diff(line, None, status, resp.status_code)]
+            resp = next(hops, None)
+
+            if resp is None:
+                # Not redirected as far as responses are defined
+                self.report.append(Testcase.Diff(line, None, status, None))
+                return False
+
+            if resp.status_code != status:
+                self.report.append(Testcase.Diff(line, None, status, resp.status_code))
 
             for header, content in expect.headers.items():
                 if header not in resp.headers:
-                    Testcase.report += [Testcase.Diff(line, header, content, None)]
+                    self.report.append(Testcase.Diff(line, header, content, None))
                 else:
                     if resp.headers[header] != content:
-                        Testcase.report += [
+                        self.report.append(
                             Testcase.Diff(line, header, content, resp.headers[header])
-                        ]
-
-            for data in expect.data:
-                op, expect = data[:1], data[1:]
-
-                if op == "=":
-                    if expect not in resp.text:
-                        Testcase.report += [Testcase.Diff(line, op, data, resp.text)]
-                elif op == "~":
-                    if not re.search(expect, resp.text):
-                        Testcase.report += [Testcase.Diff(line, op, data, resp.text)]
-                elif op == "/":
-                    try:
-                        doc = html.document_fromstring(resp.text)
-                        result = doc.xpath(f"/{expect}")
-
-                        if not result:
-                            Testcase.report += [
-                                Testcase.Diff(line, op, data, resp.text)
-                            ]
-                    except XPathEvalError:
-                        Testcase.report += [
-                            Testcase.Diff(line, op, data, "Invalid XPath")
-                        ]
-
-            if Testcase.report:
-                return False
+                        )
+
+            body = ResponseBody(resp)
 
-            uri = resp.headers["location"] if "location" in resp.headers else None
+            for check, payload, data in expect.data:
+                if not check(payload, body):
+                    self.report.append(Testcase.Diff(line, data[:1], data, body.text))
+
+            if not cached:
+                # Shared responses have been read or closed by `fetch()`
+                body.close()
+
+            if self.report:
+                return False
 
         return True
 
@@ -241,56 +495,51 @@ class TestSuite:  # pylint: disable=too-few-public-methods
         line number, request and expected response"""
 
         tests = []
-        lineno = 0
+        uri = None
 
-        with open(filename, "r", encoding="utf-8") as stream:
-            uri = None
+        # Read at once and split in C, instead of going through the buffered
+        # line-by-line text IO. Newlines are already translated by `read_text()`.
+        lines = Path(filename).read_text(encoding="utf-8").split("\n")
 
-            for line in stream:
-                lineno += 1
-                line = line.strip()
+        for lineno, line in enumerate(lines, 1):
+            line = line.strip()
 
-                if line:
-                    statement = line[:1]
-                    line = line[1:].strip()
+            if line:
+                statement, line = line[:1], line[1:].strip()
 
-                    if statement == "#":
-                        # comment
-                        continue
+                if statement == "#":
+                    # comment
+                    continue
 
-                    if statement == "<":
-                        # request
+                if statement == "<":
+                    # request
+                    try:
+                        # HEAD http://localhost
+                        method, uri = line.split(" ", maxsplit=1)
+                        testcase = Testcase(lineno, uri, method)
+                    except ValueError:
+                        # http://localhost
+                        method = "HEAD"
+                        uri = line
+                        testcase = Testcase(lineno, uri)
+
+                    tests.append(testcase)
+
+                elif statement == ">":
+                    # response
+                    if line.startswith(("=", "~", "/")):
+                        testcase.adddata(lineno, line)
+                    else:
                         try:
-                            # HEAD http://localhost
-                            method, uri = line.split(" ", maxsplit=1)
-                            testcase = Testcase(lineno, uri, method)
+                            # Content-Type: text/html; charset=UTF-8
+                            header, content = line.split(": ")
+                            testcase.addheader(header, content)
                         except ValueError:
-                            # http://localhost
-                            method = "HEAD"
-                            uri = line
-                            testcase = Testcase(lineno, uri)
-
-                        tests += [testcase]
-
-                    elif statement == ">":
-                        # response
-                        if (
-                            line.startswith("=")
-                            or line.startswith("~")
-                            or line.startswith("/")
-                        ):
-                            testcase.adddata(line)
-                        else:
-                            try:
-                                # Content-Type: text/html; charset=UTF-8
-                                header, content = line.split(": ")
-                                testcase.addheader(header, content)
-                            except ValueError:
-                                # 301
-                                testcase.addresp(lineno, int(line))
+                            # 301
+                            testcase.addresp(lineno, int(line))
 
-                    else:
-                        raise SyntaxWarning(lineno)
+                else:
+                    raise SyntaxWarning(lineno)
 
         return tests
 
@@ -310,29 +559,71 @@ if __name__ == "__main__":
     parser.add_argument(
         "-A", "--user-agent", type=str, help="Use the specified user agent"
     )
+    parser.add_argument(
+        "--no-cache",
+        action="store_true",
+        help="Request again for each test, even if sending the same request",
+    )
+    parser.add_argument(
+        "-j", "--jobs", type=int, default=16, help="Run this many tests in parallel"
+    )
 
     args, files = parser.parse_known_args()
 
-    for file in files:
-        if args.verbose and len(files) > 1:
-            print(file)
+    if args.jobs < 1:
+        parser.error("argument -j/--jobs: must be at least 1")
 
-        if args.cookie:
-            Testcase.cookies["X-Test"] = ".htaccess"
+    # All workers may be requesting the same host at once, so keep as many
+    # connections per host. Blocking caps them there instead of opening
+    # surplus connections which would be discarded after a single request.
+    _adapter = HTTPAdapter(pool_connections=32, pool_maxsize=args.jobs, pool_block=True)
+    atexit.register(_adapter.close)
 
-        if args.header:
-            Testcase.headers["X-Test"] = ".htaccess"
+    Testcase.cache = not args.no_cache
 
-        Testcase.headers["User-Agent"] = (
-            args.user_agent if args.user_agent else f"htaccess-test/{VERSION}"
-        )
+    with ThreadPoolExecutor(max_workers=args.jobs) as executor:
+        for file in files:
+            if args.verbose and len(files) > 1:
+                print(file)
+
+            if args.cookie:
+                Testcase.cookies["X-Test"] = ".htaccess"
+
+            if args.header:
+                Testcase.headers["X-Test"] = ".htaccess"
+
+            Testcase.headers["User-Agent"] = (
+                args.user_agent if args.user_agent else f"htaccess-test/{VERSION}"
+            )
+
+            testsuite = TestSuite.load(file)
+
+            # When running in parallel, tests for the same host are started one
+            # after another, so that they find the connections of their
+            # predecessors in the pool. Otherwise they are run in file order.
+            if args.jobs > 1:
+                testsuite.sort(key=lambda test: urlsplit(test.uri).netloc)
+
+            pending = iter(testsuite)
+
+            # Tests are run concurrently, but no more than `--jobs` ahead of the
+            # one being reported, so that only few are sent after a mismatch
+            running = deque(
+                (test, executor.submit(test.execute))
+                for test in itertools.islice(pending, args.jobs)
+            )
+
+            while running:
+                test, execution = running.popleft()
+
+                if args.verbose:
+                    print(test.request)
 
-        testsuite = TestSuite.load(file)
+                if not execution.result():
+                    print(test)
+                    sys.exit(1)
 
-        for test in testsuite:
-            if args.verbose:
-                print(test.request)
+                test = next(pending, None)
 
-            if not test.execute():
-                print(test)
-                sys.exit(1)
+                if test is not None:
+                    running.append((test, executor.submit(test.execute)))